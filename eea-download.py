@@ -3,13 +3,38 @@ import urllib.parse
 
 import geopandas
 import httpx
+import numpy as np
 import pandas as pd
 
-from utils import EEA_PATH, REGIONS, a_maybe_download, filter_none, load_nuts
-
-client = httpx.AsyncClient()
+from utils import (
+    EEA_PATH,
+    REGIONS,
+    a_load_nuts,
+    a_maybe_download,
+    close_async_http_client,
+    flatten,
+    get_async_http_client,
+    get_region_df,
+)
+
+MAX_CONCURRENT_REQUESTS = 100
+
+# all requests, the NUTS downloads included, share the client of the event loop
+HTTP_LIMITS = httpx.Limits(
+    max_connections=MAX_CONCURRENT_REQUESTS, max_keepalive_connections=50
+)
+# bounds the number of requests in flight, set in main() so that it belongs to
+# the running event loop (python 3.9 binds it to the loop on creation)
+requests_semaphore = None
 
 HOUR = pd.Timedelta(hours=1)
+RELEVANT_VARS = [
+    "DatetimeBegin",
+    "DatetimeEnd",
+    "AirQualityStation",
+    "AirPollutant",
+    "Concentration",
+]
 pollutants = {
     "5": "PM10",
     "1": "SO2",
@@ -19,8 +44,13 @@ pollutants = {
 }
 
 
+async def download(url, folder=None):
+    async with requests_semaphore:
+        return await a_maybe_download(url, folder=folder)
+
+
 async def load_stations():
-    station_file = await a_maybe_download(
+    station_file = await download(
         "https://discomap.eea.europa.eu/map/fme/metadata/PanEuropean_metadata.csv"
     )
     all_stations = pd.read_csv(station_file, sep=r"\t", engine="python")
@@ -53,34 +83,33 @@ async def get_csvs_for_station_pollutant(station, pollutant, ccode):
         + query
     )
     print(list_url)
-    r = await client.get(list_url, timeout=None)
+    async with requests_semaphore:
+        r = await get_async_http_client().get(list_url, timeout=None)
 
     if r.status_code == 204:
         return
     urls = r.content.decode("utf-8-sig").splitlines()
-    filepaths = [await a_maybe_download(url, folder=EEA_PATH / "raw") for url in urls]
+    filepaths = await asyncio.gather(
+        *[download(url, folder=EEA_PATH / "raw") for url in urls]
+    )
 
     return filepaths
 
 
 async def get_data_for_pollutant(pollutant, station, ccode, region_id):
+    """
+    One dataframe pr downloaded file, they are concatenated once in main()
+    """
     filepaths = await get_csvs_for_station_pollutant(station, pollutant, ccode)
     if filepaths is None:
-        return
-    dfs = [pd.read_csv(path) for path in filepaths if path is not None]
-    station_pollutant_df = pd.concat(dfs)
-    relevant_vars = [
-        "DatetimeBegin",
-        "DatetimeEnd",
-        "AirQualityStation",
-        "AirPollutant",
-        "Concentration",
+        return []
+    return [
+        pd.read_csv(
+            path, usecols=RELEVANT_VARS, dtype={"Concentration": "float32"}
+        ).assign(pollutant=pollutant, region=region_id, station_id=station)
+        for path in filepaths
+        if path is not None
     ]
-    station_pollutant_df = station_pollutant_df[relevant_vars]
-    station_pollutant_df["pollutant"] = pollutant
-    station_pollutant_df["region"] = region_id
-    station_pollutant_df["station_id"] = station
-    return station_pollutant_df
 
 
 async def get_data_for_station(station, ccode, region_id):
@@ -90,22 +119,19 @@ async def get_data_for_station(station, ccode, region_id):
             for pollutant in pollutants
         ]
     )
-    station_pollutant_dfs = filter_none(station_pollutant_dfs)
-    if not station_pollutant_dfs:
-        return
-    station_df = pd.concat(station_pollutant_dfs)
-    return station_df
+    return flatten(station_pollutant_dfs)
 
 
 async def get_data_for_region(region_id, nuts_df, all_stations):
     print(region_id)
     ccode = region_id[:2].replace("UK", "GB")
-    region_df = nuts_df[nuts_df["NUTS_ID"] == region_id]
-    assert len(region_df) == 1, region_df
-    region_geometry = region_df.iloc[0].geometry
+    region_geometry = get_region_df(nuts_df, region_id).iloc[0].geometry
 
-    country_stations = all_stations[all_stations["Countrycode"] == ccode]
-    region_stations = country_stations[country_stations.within(region_geometry)]
+    # the spatial index is built once on all_stations and shared by all regions.
+    # region contains station is the same test as station within region
+    in_region = all_stations.sindex.query(region_geometry, predicate="contains")
+    region_stations = all_stations.iloc[np.sort(in_region)]
+    region_stations = region_stations[region_stations["Countrycode"] == ccode]
     print("region stations: ", len(region_stations))
 
     station_dfs = await asyncio.gather(
@@ -114,24 +140,28 @@ async def get_data_for_region(region_id, nuts_df, all_stations):
             for station in list(region_stations["AirQualityStation"])
         ]
     )
-    station_dfs = filter_none(station_dfs)
-    if not station_dfs:
-        return
-    region_df = pd.concat(station_dfs)
-    return region_df
+    return flatten(station_dfs)
 
 
 async def main():
-    nuts_df = load_nuts()
-    all_stations = await load_stations()
-    region_dfs = await asyncio.gather(
-        *[
-            get_data_for_region(region_id, nuts_df, all_stations)
-            for region_id in REGIONS
-        ]
-    )
-    region_dfs = filter_none(region_dfs)
-    df = pd.concat(region_dfs)
+    global requests_semaphore
+    requests_semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    # created with the limits of this script before anything else uses it
+    get_async_http_client(limits=HTTP_LIMITS)
+
+    try:
+        nuts_df, all_stations = await asyncio.gather(
+            a_load_nuts(nuts_ids=REGIONS), load_stations()
+        )
+        region_dfs = await asyncio.gather(
+            *[
+                get_data_for_region(region_id, nuts_df, all_stations)
+                for region_id in REGIONS
+            ]
+        )
+    finally:
+        await close_async_http_client()
+    df = pd.concat(flatten(region_dfs), ignore_index=True, copy=False)
     print(df["region"].value_counts())
     df.to_parquet(EEA_PATH / "eea-stations.pqt")  # FIXME
 
@@ -26,6 +26,8 @@ def clean_dates(df):
 
 
 def group_by_day(df):
+    # only the concentration is used from here on, the quantile of the other
+    # columns (the end times, the string codes) was calculated and thrown away
     return (
         df.groupby(
             [
@@ -34,7 +36,7 @@ def group_by_day(df):
                 "AirPollutant",
                 pd.Grouper(key="DatetimeBegin", freq="D"),
             ]
-        )
+        )[["Concentration"]]
         .quantile(0.99)
         .sort_index()
         .reset_index()
@@ -62,9 +64,13 @@ def calculate_n_days_sum(df, n):
 def calculate_index_variables(df_in):
     # calculate indices
     def _bin_var(name, bins):
-        return (
-            pd.cut(df_in[name], bins, labels=False) if name in df_in.columns else np.nan
-        )
+        if name not in df_in.columns:
+            return np.nan
+        # same labels as pd.cut(values, bins, labels=False), bins are closed on the right
+        values = df_in[name].to_numpy(dtype="float64")
+        labels = np.searchsorted(bins[1:-1], values, side="left").astype("float64")
+        labels[~(values > bins[0])] = np.nan
+        return labels
 
     # use infinity to get infinite upper bounds
     indices = pd.DataFrame(
@@ -74,7 +80,8 @@ def calculate_index_variables(df_in):
             "aqiwdso2": _bin_var("SO2", [0, 100, 200, 350, 500, 750, np.inf]),
             "aqiwdno2": _bin_var("NO2", [0, 40, 90, 120, 230, 340, np.inf]),
             "aqiwdo3": _bin_var("O3", [0, 50, 100, 130, 240, 380, np.inf]),
-        }
+        },
+        index=df_in.index,
     )
 
     # Worst air quality index level across pollutants
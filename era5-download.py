@@ -1,3 +1,5 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from functools import partial
 from itertools import product
 from pathlib import Path
 
@@ -6,12 +8,22 @@ import geopandas
 import numpy as np
 import pandas as pd
 import pyarrow as pa
+import pyarrow.dataset as ds
 import pyarrow.parquet as pq
+import pygeos
 from rich.progress import track
-import shapely
 import xarray as xr
 
-from utils import ERA5_PATH, GLOBAL_POP_FILE, REGIONS, TMP_PATH, load_geostat, load_nuts
+from utils import (
+    ERA5_PATH,
+    GLOBAL_POP_FILE,
+    REGION_WORKERS,
+    REGIONS,
+    TMP_PATH,
+    get_region_df,
+    load_geostat,
+    load_nuts,
+)
 
 MONTHS = ["01", "02", "03", "04", "05", "06", "07", "08", "09", "10", "11", "12"]
 
@@ -62,11 +74,29 @@ era5_cols = {
     "iwg10": "i10fg",
 }
 
+# zstd files are much smaller than snappy, and row groups with statistics let
+# filtered reads skip the row groups that can not match
+PARQUET_WRITE_OPTIONS = {
+    "compression": "zstd",
+    "compression_level": 3,
+    "use_dictionary": True,
+    "write_statistics": True,
+    "data_page_size": 1 << 20,
+}
+ROW_GROUP_SIZE = 1_000_000
+
+# the retrievals running at once on the CDS account. all downloads of all regions
+# go through one pool of this size in main(), sharing the one client
+CDS_WORKERS = 8
 cds_client = cdsapi.Client()
 
 
+def make_era5_path(era5_id: str, region_id, year: str, month) -> Path:
+    return ERA5_PATH / "raw" / f"{era5_id}{region_id}y{year}m{month}.netcdf"
+
+
 def download_era5(era5_id: str, region_id, region_geometry, year: str, month) -> Path:
-    path = ERA5_PATH / "raw" / f"{era5_id}{region_id}y{year}m{month}.netcdf"
+    path = make_era5_path(era5_id, region_id, year, month)
     Path(ERA5_PATH / "raw").mkdir(exist_ok=True)
     if path.exists():
         return path
@@ -94,56 +124,97 @@ def download_era5(era5_id: str, region_id, region_geometry, year: str, month) ->
     return path
 
 
-def read_netcdf(era5_id, filepath: Path) -> pd.DataFrame:
+def read_netcdfs(era5_id, filepaths: list[Path]) -> xr.DataArray:
+    """
+    Read the monthly files of one variable into one array along the time axis
+    """
     col = era5_cols[era5_id]
-    ncx = xr.open_dataset(str(filepath))
-    df = ncx[col].to_dataframe()
-    ncx.close()
-    df = df.rename(columns={col: era5_id})
-    return df
-
-
-def make_month_df(region_id, region_geometry, year, month):
-    month_measure_dfs = []
-    for era5_id in era5_cols.keys():
-        month_filepath = download_era5(
-            era5_id, region_id, region_geometry, str(year), str(month)
+    month_arrays = []
+    for filepath in filepaths:
+        with xr.open_dataset(str(filepath)) as ncx:
+            # float32 from the start, each month is cast while it is small
+            month_arrays.append(ncx[col].load().astype("float32"))
+    return xr.concat(month_arrays, dim="time").rename(era5_id)
+
+
+def download_all(nuts_df):
+    """
+    Download the monthly files of every region and variable, CDS_WORKERS at a time
+    """
+    region_geometries = {
+        region_id: get_region_df(nuts_df, region_id).iloc[0].geometry
+        for region_id in REGIONS
+    }
+    with ThreadPoolExecutor(max_workers=CDS_WORKERS) as executor:
+        try:
+            futures = [
+                executor.submit(
+                    download_era5, era5_id, region_id, geometry, year, month
+                )
+                for region_id, geometry in region_geometries.items()
+                for era5_id in era5_cols.keys()
+                for year, month in product(YEARS, MONTHS)
+            ]
+            for future in track(
+                as_completed(futures), total=len(futures), description="Downloading"
+            ):
+                future.result()
+        except BaseException:
+            # do not wait for the queued retrievals before raising
+            executor.shutdown(cancel_futures=True)
+            raise
+
+
+def make_grids_df(region_id) -> pd.DataFrame:
+    """
+    Hourly values pr grid for the whole period, one column pr variable
+    """
+    year_months = list(product(YEARS, MONTHS))
+    measures = [
+        read_netcdfs(
+            era5_id,
+            [
+                make_era5_path(era5_id, region_id, year, month)
+                for year, month in year_months
+            ],
         )
-        month_measure_df = read_netcdf(era5_id, month_filepath)
-        month_measure_dfs.append(month_measure_df)
-    df = pd.concat(month_measure_dfs, axis=1).reset_index()
-    # df["time"] = df["time"].astype("int32")
+        for era5_id in era5_cols.keys()
+    ]
+    # combine in xarray and convert to a dataframe once
+    df = (
+        xr.merge(measures)
+        .to_dataframe(dim_order=["time", "latitude", "longitude"])
+        .reset_index()
+    )
+    # pandas indexes are float64, so the coordinates are cast after reset_index
     df["longitude"] = df["longitude"].astype("float32")
     df["latitude"] = df["latitude"].astype("float32")
-    df["tmpdc"] = df["tmpdc"].astype("float32")
-    df["pac"] = df["pac"].astype("float32")
-    df["iwg10"] = df["iwg10"].astype("float32")
     return df
 
 
 def merge_population_data(df_in, region_df) -> pd.Series:
     # grid_df: one row pr grid
     grid_df = df_in[["grid_id", "longitude", "latitude"]].drop_duplicates()
-    grid_df["box"] = grid_df.apply(
-        lambda x: shapely.geometry.Polygon(
-            [
-                [x["longitude"] - HALF_STEP, x["latitude"] - HALF_STEP],
-                [x["longitude"] + HALF_STEP, x["latitude"] - HALF_STEP],
-                [x["longitude"] + HALF_STEP, x["latitude"] + HALF_STEP],
-                [x["longitude"] - HALF_STEP, x["latitude"] + HALF_STEP],
-            ]
-        ),
+    # build all the grid boxes in one call, corners shape: (n_grids, 4, 2)
+    lon = grid_df["longitude"].to_numpy(dtype="float64")
+    lat = grid_df["latitude"].to_numpy(dtype="float64")
+    corners = np.stack(
+        [
+            np.stack([lon - HALF_STEP, lat - HALF_STEP], axis=1),
+            np.stack([lon + HALF_STEP, lat - HALF_STEP], axis=1),
+            np.stack([lon + HALF_STEP, lat + HALF_STEP], axis=1),
+            np.stack([lon - HALF_STEP, lat + HALF_STEP], axis=1),
+        ],
         axis=1,
     )
+    grid_df["box"] = pygeos.polygons(corners)
     grid_df = grid_df.drop(columns=["longitude", "latitude"])
     grid_df = geopandas.GeoDataFrame(grid_df, geometry="box", crs="EPSG:4326")
 
-    # pop_df: one row per square meter in square containing region
-    pop_df = load_geostat(GLOBAL_POP_FILE, region_df).rename(columns={0: "pop"})
-    pop_df["LEVL_CODE"] = pop_df["LEVL_CODE"].astype("int8")
-    pop_df["pop"] = pop_df["pop"].astype("float32")
-    pop_df["x"] = pop_df["x"].astype("int32")
-    pop_df["y"] = pop_df["y"].astype("int32")
+    # pop_df: one row per square meter in square containing region, only the
+    # population and the point are carried through the join
+    pop_df = load_geostat(GLOBAL_POP_FILE, region_df).rename(columns={"value": "pop"})
+    pop_df = pop_df[["pop", "geometry"]].astype({"pop": "float32"})
 
     # grid_pop_df: one row per square meter in grid, with population in grid_id
     grid_pop_df = (
@@ -162,41 +233,55 @@ def make_region_grids_table(nuts_df, region_id: str) -> pa.Table:
     path = TMP_PATH / f"tmp{region_id}era5.pqt"
 
     print(f"make_region_month_df {region_id}")
-    region_df = nuts_df[nuts_df["NUTS_ID"] == region_id]
-    assert len(region_df) == 1, region_df
-    region_geometry = region_df.iloc[0].geometry
+    region_df = get_region_df(nuts_df, region_id)
 
-    month_dfs = [
-        make_month_df(region_id, region_geometry, year, month)
-        for year, month in track(list(product(YEARS, MONTHS)))
-    ]
-
-    df = pd.concat(month_dfs)
+    df = make_grids_df(region_id)
     df["region"] = region_id
-    df["grid_id"] = df.groupby(["longitude", "latitude"]).ngroup()
-    df["grid_id"] = df["grid_id"].astype("int16")
+    # pack the grid position into one integer key, hashing it is cheaper than
+    # sorting on the two float columns
+    lat_i = np.round((df["latitude"].to_numpy() + 90) / STEP).astype("uint64")
+    lon_i = np.round((df["longitude"].to_numpy() + 180) / STEP).astype("uint64")
+    grid_key = (lat_i << np.uint64(32)) | lon_i
+    df["grid_id"] = pd.factorize(grid_key)[0].astype("int16")
 
     population_by_grid = merge_population_data(df, region_df)
     df = df.merge(population_by_grid, left_on="grid_id", right_index=True)
     table = pa.Table.from_pandas(df)
-    pq.write_table(table, path)
+    pq.write_table(table, path, row_group_size=ROW_GROUP_SIZE, **PARQUET_WRITE_OPTIONS)
     return path
 
 
 def main():
     print("main")
-    nuts_df = load_nuts()
-    region_table_paths = [
-        make_region_grids_table(nuts_df=nuts_df, region_id=region_id)
-        for region_id in REGIONS
-    ]
+    nuts_df = load_nuts(nuts_ids=REGIONS)
+    download_all(nuts_df)
+    # regions are independent, process them in parallel
+    with ProcessPoolExecutor(max_workers=REGION_WORKERS) as executor:
+        try:
+            region_table_paths = list(
+                executor.map(partial(make_region_grids_table, nuts_df), REGIONS)
+            )
+        except BaseException:
+            executor.shutdown(cancel_futures=True)
+            raise
     region_tables = [pq.read_table(path) for path in region_table_paths]
 
     print("Concat region tables")
     table = pa.concat_tables(region_tables)
-    path = ERA5_PATH / "era5-grids.pqt"
+    path = ERA5_PATH / "era5-grids"
     print("save")
-    pq.write_table(table, path)
+    # partitioned by region, so that reading one region only reads its own files
+    ds.write_dataset(
+        table,
+        path,
+        format="parquet",
+        file_options=ds.ParquetFileFormat().make_write_options(**PARQUET_WRITE_OPTIONS),
+        partitioning=["region"],
+        partitioning_flavor="hive",
+        existing_data_behavior="delete_matching",
+        min_rows_per_group=ROW_GROUP_SIZE,
+        max_rows_per_group=ROW_GROUP_SIZE,
+    )
 
 
 if __name__ == "__main__":
@@ -1,25 +1,37 @@
+from concurrent.futures import ProcessPoolExecutor
 from functools import partial
 
 import numpy as np
 import pandas as pd
+import pyarrow as pa
 import pyarrow.compute as pc
 import pyarrow.dataset as ds
 import pyreadstat
 import pytz
 from rich.progress import track
 
-from utils import ERA5_PATH, TMP_PATH, ERA5_VARIABLE_VALUES, REGIONS, TIMEZONES
+from utils import (
+    ERA5_PATH,
+    TMP_PATH,
+    ERA5_VARIABLE_VALUES,
+    REGION_WORKERS,
+    REGIONS,
+    TIMEZONES,
+)
 
 
 def create_date_column(df):
-    # make time variable timezone aware
-    df["time"] = df["time"].dt.tz_localize(pytz.utc)
-    df["date"] = pd.Series(dtype="object")
-    for region_id, tz_name in TIMEZONES.items():
-        df["date"] = df["date"].mask(
-            cond=df["region"] == region_id,
-            other=df["time"].dt.tz_convert(tz_name).dt.date,
-        )
+    # the hourly times are in utc, localize them once
+    utc_time = df["time"].dt.tz_localize(pytz.utc)
+    # one conversion pr timezone, on the rows of the regions in that timezone.
+    # the local date is kept as a naive datetime (midnight) so grouping on it
+    # hashes integers instead of date objects. do_for_region converts it to dates.
+    timezones = df["region"].map(TIMEZONES)
+    dates = np.full(len(df), np.datetime64("NaT"), dtype="datetime64[ns]")
+    for tz_name, idx in df.groupby(timezones, observed=True).indices.items():
+        local_time = utc_time.iloc[idx].dt.tz_convert(tz_name)
+        dates[idx] = local_time.dt.tz_localize(None).dt.normalize().to_numpy()
+    df["date"] = dates
     df = df.drop(columns=["time"])
     return df
 
@@ -34,93 +46,108 @@ def groupby_date(df_in: pd.DataFrame) -> pd.DataFrame:
     """
     Calculate grid-based daily values
     """
-    daily_grouper = df_in.groupby(["region", "grid_id", "date"])
-    df = pd.DataFrame(
-        {
-            "pop": daily_grouper["pop"].first(),
-            "tmpdca": daily_grouper["tmpdc"].mean(numeric_only=True),
-            "tmpdcmx": daily_grouper["tmpdc"].max(),
-            "tmpdcmn": daily_grouper["tmpdc"].min(),
-            "paccta": daily_grouper["pac"].sum(),
-            "iwg10mx": daily_grouper["iwg10"].max(),
-        }
+    return df_in.groupby(["region", "grid_id", "date"], observed=True).agg(
+        pop=("pop", "first"),
+        tmpdca=("tmpdc", "mean"),
+        tmpdcmx=("tmpdc", "max"),
+        tmpdcmn=("tmpdc", "min"),
+        paccta=("pac", "sum"),
+        iwg10mx=("iwg10", "max"),
     )
-    return df
 
 
-def calculating_moving_averages(df):
-    df = df.copy()
-    df = df.reset_index()
-    # convert 'date' from date dtype to datetime to facilitate rolling averages
-    df = df.set_index(pd.to_datetime(df.pop("date"), utc=True))
+def running_total(arr: np.ndarray) -> np.ndarray:
+    """
+    Cumulative sum along the rows, with a leading row of zeros
+    """
+    return np.concatenate([np.zeros((1, arr.shape[1])), np.cumsum(arr, axis=0)])
 
-    groupby = df.groupby("region")
-    averages = pd.DataFrame(
-        {
-            "tmpdcaw": groupby["tmpdca"].rolling("7D").mean(),
-            "tmpdcam": groupby["tmpdca"].rolling("30D").mean(),
-            "tmpdca3m": groupby["tmpdca"].rolling("90D").mean(),
-            "tmpdcay": groupby["tmpdca"].rolling("365D").mean(),
-            "pacctaw": groupby["paccta"].rolling("7D").sum(),
-            "pacctam": groupby["paccta"].rolling("30D").sum(),
-            "paccta3m": groupby["paccta"].rolling("90D").sum(),
-            "pacctay": groupby["paccta"].rolling("365D").sum(),
-            "iwg10mxaw": groupby["iwg10mx"].rolling("7D").mean(),
-            "iwg10mxam": groupby["iwg10mx"].rolling("30D").mean(),
-            "iwg10mxa3m": groupby["iwg10mx"].rolling("90D").mean(),
-            "iwg10mxay": groupby["iwg10mx"].rolling("365D").mean(),
-        }
-    )
-    # convert 'date' from back to date
-    averages = averages.reset_index()
-    averages["date"] = averages["date"].dt.date
-    averages = averages.set_index(["region", "date"])
 
-    return averages
+def calculating_moving_averages(df):
+    """
+    Rolling averages (sums for precipitation) over the days before each date.
+
+    A window (t - n days, t] is the difference between two rows of the running
+    totals, so all windows and columns are calculated in one pass over the data.
+    """
+    # column: (prefix of the output columns, aggregation)
+    aggregations = {
+        "tmpdca": ("tmpdca", "mean"),
+        "paccta": ("paccta", "sum"),
+        "iwg10mx": ("iwg10mxa", "mean"),
+    }
+    windows = {"w": "7D", "m": "30D", "3m": "90D", "y": "365D"}
+
+    region_averages = []
+    for _, region_df in df[list(aggregations)].groupby(level="region", observed=True):
+        region_df = region_df.sort_index()
+        dates = pd.to_datetime(region_df.index.get_level_values("date")).values
+        values = region_df.to_numpy(dtype="float64")
+        is_valid = ~np.isnan(values)
+        sums = running_total(np.where(is_valid, values, 0))
+        counts = running_total(is_valid)
+
+        end = np.arange(1, len(dates) + 1)
+        averages = {}
+        for suffix, window in windows.items():
+            start = np.searchsorted(dates, dates - pd.Timedelta(window), side="right")
+            window_sums = sums[end] - sums[start]
+            window_counts = counts[end] - counts[start]
+            with np.errstate(invalid="ignore", divide="ignore"):
+                window_means = window_sums / window_counts
+            window_sums[window_counts == 0] = np.nan
+            for i, (prefix, aggregation) in enumerate(aggregations.values()):
+                result = window_means if aggregation == "mean" else window_sums
+                averages[prefix + suffix] = result[:, i]
+        region_averages.append(pd.DataFrame(averages, index=region_df.index))
+
+    return pd.concat(region_averages)
 
 
 def calculating_anomalies(df_in):
-    df = df_in.reset_index()
-    df["cal_month"] = df["date"].apply(lambda val: val.month)
-    df["year_month"] = df["date"].apply(lambda val: f"{val.year}-{val.month}")
-    df_baseline = df[df["date"].apply(lambda val: 1991 <= val.year <= 2020)]
-    tmp_cal_month_groupby = df_baseline.groupby("cal_month")["tmpdca"]
+    """
+    Monthly values and deviations from the calendar month baseline (1991-2020).
+
+    Works on the daily index directly, the monthly and baseline values are
+    broadcast back by position, so the result lines up with df_in.
+    """
+    dates = pd.DatetimeIndex(df_in.index.get_level_values("date"))
+    cal_month = dates.month.to_numpy()
+    year_month = (dates.year * 100 + dates.month).to_numpy()
+    in_baseline = (dates.year >= 1991) & (dates.year <= 2020)
 
-    tmpdcamb = tmp_cal_month_groupby.aggregate("mean")
-    tmpdcamb.name = "tmpdcamb"
-    df = df.join(tmpdcamb, on="cal_month")
+    monthly = df_in.groupby(year_month)
+    df = pd.DataFrame(
+        {
+            "tmpdca": df_in["tmpdca"],
+            "tmpdcacm": monthly["tmpdca"].transform("mean"),
+            # sum daily to year_monthly first
+            "pacctcm": monthly["paccta"].transform("sum"),
+            "iwg10mx": df_in["iwg10mx"],
+        },
+        index=df_in.index,
+    )
 
-    tmp95pacmb = tmp_cal_month_groupby.aggregate(partial(np.percentile, q=95))
-    tmp95pacmb.name = "tmp95pacmb"
-    df = df.join(tmp95pacmb, on="cal_month")
+    # calculate pr calendar month for the baseline, and broadcast back
+    baseline = df[in_baseline].groupby(cal_month[in_baseline])
+    baseline_values = pd.DataFrame(
+        {
+            "tmpdcamb": baseline["tmpdca"].mean(),
+            "tmp95pacmb": baseline["tmpdca"].aggregate(partial(np.percentile, q=95)),
+            "pacctmb": baseline["pacctcm"].mean(),
+            "iwg10mxamb": baseline["iwg10mx"].mean(),
+        }
+    )
+    for col, values in baseline_values.reindex(cal_month).items():
+        df[col] = values.to_numpy()
 
+    # anomalies
     df["tmpanod"] = df["tmpdca"] - df["tmpdcamb"]
     # more_than_95p = df["tmpdca"] > df["tmp95pacmb"]
     # df["tmp95p3d"] = more_than_95p.rolling(3, min_periods=3).sum()
-
-    df["tmpdcacm"] = df.groupby("year_month")["tmpdca"].transform("mean")
     df["tmpanocm"] = df["tmpdcacm"] - df["tmpdcamb"]
-
-    # paccta
-    # sum daily to year_monthly first
-    df["pacctcm"] = df.groupby("year_month")["paccta"].transform("sum")
-    df_baseline["pacctcm"] = df_baseline.groupby("year_month")["paccta"].transform(
-        "sum"
-    )
-    # calculate monthly for baseline, join back in
-    pac_cal_month_groupby = df_baseline.groupby("cal_month")["pacctcm"]
-    pacctmb = pac_cal_month_groupby.aggregate("mean")
-    pacctmb.name = "pacctmb"
-    df = df.join(pacctmb, on="cal_month")
-    # anomalies
     df["paccdcm"] = (df["pacctcm"] / df["pacctmb"]) * 100
 
-    iwg_cal_month_groupby = df_baseline.groupby("cal_month")["iwg10mx"]
-    iwg10mxamb = iwg_cal_month_groupby.aggregate("mean")
-    iwg10mxamb.name = "iwg10mxamb"
-    df = df.join(iwg10mxamb, on="cal_month")
-
-    df = df.set_index(["region", "date"])
     df = df[
         [
             "tmpdcamb",
@@ -138,17 +165,21 @@ def calculating_anomalies(df_in):
     return df
 
 
-def weighted_average(group, var_name):
-    return np.average(group[var_name], weights=group["pop"])
-
-
 def collapse_grid(df: pd.DataFrame) -> pd.DataFrame:
-    groupby = df.groupby(["region", "date"])
-    cols = set(df.columns) - {"region", "grid_id", "date", "pop"}
-    res = pd.DataFrame(
-        {col: groupby.apply(partial(weighted_average, var_name=col)) for col in cols}
+    """
+    Population weighted average of the grid values pr region and date
+    """
+    cols = [
+        col for col in df.columns if col not in {"region", "grid_id", "date", "pop"}
+    ]
+    values = df[cols]
+    # only count the population of grids that have a value for the column
+    weights = values.notna().multiply(df["pop"], axis=0)
+    numerator = (
+        values.multiply(weights).groupby(["region", "date"], observed=True).sum()
     )
-    return res
+    denominator = weights.groupby(["region", "date"], observed=True).sum()
+    return numerator.div(denominator)
 
 
 def order_columns(df):
@@ -191,14 +222,16 @@ def order_columns(df):
 
 def do_for_region(region_id, path):
 
-    hourly_grids_table = ds.dataset(path).to_table(
-        filter=pc.field("region") == pc.scalar(region_id)
+    # the filter on the partition column only reads the files of this region
+    partitioning = ds.partitioning(pa.schema([("region", pa.string())]), flavor="hive")
+    hourly_grids = (
+        ds.dataset(path, partitioning=partitioning)
+        .to_table(filter=pc.field("region") == pc.scalar(region_id))
+        .to_pandas(self_destruct=True, split_blocks=True)
     )
 
-    hourly_grids = hourly_grids_table.to_pandas()
-
-    # remove other region ids from categorical region_id variable
-    # hourly_grids["region"] = hourly_grids["region"].cat.remove_unused_categories()
+    # a categorical region is smaller and faster to group on than strings
+    hourly_grids["region"] = hourly_grids["region"].astype("category")
 
     hourly_grids = create_date_column(hourly_grids)
 
@@ -220,9 +253,9 @@ def do_for_region(region_id, path):
 
     # strip off the first year (not enough data for the rolling averages)
     # and the last year (which only exists because of the timezone shift from 2022-12-31:23 -> 2023-01-01:00
-    daily_merged = daily_merged[
-        daily_merged["date"].apply(lambda val: 1991 <= val.year <= 2022)
-    ]
+    daily_merged = daily_merged[daily_merged["date"].dt.year.between(1991, 2022)].copy()
+    daily_merged["date"] = daily_merged["date"].dt.date
+    daily_merged["region"] = daily_merged["region"].astype(str)
 
     save_path = TMP_PATH / (region_id + ".pqt")
     daily_merged.to_parquet(save_path)
@@ -236,8 +269,19 @@ def check_labeled(df):
 
 
 def main() -> pd.DataFrame:
-    path = ERA5_PATH / "era5-grids.pqt"
-    region_df_paths = [do_for_region(region_id, path) for region_id in track(REGIONS)]
+    path = ERA5_PATH / "era5-grids"
+    # regions are independent, process them in parallel
+    with ProcessPoolExecutor(max_workers=REGION_WORKERS) as executor:
+        try:
+            region_df_paths = list(
+                track(
+                    executor.map(partial(do_for_region, path=path), REGIONS),
+                    total=len(REGIONS),
+                )
+            )
+        except BaseException:
+            executor.shutdown(cancel_futures=True)
+            raise
     region_dfs = [pd.read_parquet(path) for path in region_df_paths]
 
     print("concat")
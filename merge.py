@@ -1,6 +1,8 @@
-import datetime as dt
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from pathlib import Path
 
+import pandas as pd
 import pyarrow as pa
 import pyarrow.parquet as pq
 import pyreadstat
@@ -25,14 +27,15 @@ def merge_round(ess_filename: str, eea_table: pa.Table, era5_table: pa.Table):
         df["interview_date"] = df["questcmp"].dt.date
     else:
         df = df.dropna(subset=["inwdds", "inwmms", "inwyys"])
-        df["interview_date"] = df.apply(
-            lambda row: dt.date(
-                year=int(row["inwyys"]),
-                month=int(row["inwmms"]),
-                day=int(row["inwdds"]),
-            ),
-            axis=1,
-        )
+        # invalid dates become NaT, which never match in the joins below
+        df["interview_date"] = pd.to_datetime(
+            {
+                "year": df["inwyys"].astype("int32"),
+                "month": df["inwmms"].astype("int32"),
+                "day": df["inwdds"].astype("int32"),
+            },
+            errors="coerce",
+        ).dt.date
     ess_table = pa.Table.from_pandas(df)
     print(f"ESS, {ess_table.num_rows}x{ess_table.num_columns}")
     print(ess_table["region"].value_counts())
@@ -58,11 +61,11 @@ def merge_round(ess_filename: str, eea_table: pa.Table, era5_table: pa.Table):
     path = Path("merged-EOSC-" + ess_filename).with_suffix(".pqt")
     pq.write_table(ess_eea_era5, path)
 
-    as_df = ess_eea_era5.to_pandas()
-    try:
-        as_df = as_df.drop(columns="__index_level_0__")
-    except KeyError:
-        pass
+    # drop the pandas index in arrow, and free each arrow column as it is converted
+    if "__index_level_0__" in ess_eea_era5.column_names:
+        ess_eea_era5 = ess_eea_era5.drop(["__index_level_0__"])
+    as_df = ess_eea_era5.to_pandas(split_blocks=True, self_destruct=True)
+    del ess_eea_era5
     column_labels = {
         **md.column_names_to_labels,
         **EEA_VARIABLE_LABELS,
@@ -100,8 +103,14 @@ def main():
     print(era5_table["region"].value_counts())
     print()
 
-    for filename in ESS_FILES:
-        merge_round(filename, eea_table, era5_table)
+    # ESS files are independent, merge them in parallel
+    with ProcessPoolExecutor() as executor:
+        list(
+            executor.map(
+                partial(merge_round, eea_table=eea_table, era5_table=era5_table),
+                ESS_FILES,
+            )
+        )
 
 
 if __name__ == "__main__":
@@ -1,42 +1,44 @@
+import asyncio
+import contextlib
+import os
 from pathlib import Path
+import threading
+from types import MappingProxyType
+import weakref
 
 import geopandas
 import httpx
+import numpy as np
 import pandas as pd
 from rich.progress import track
 import rioxarray as rxr
-from shapely.geometry import LineString
+import shapely.vectorized
 
 from config import EEA_PATH, ERA5_PATH, TMP_PATH, GLOBAL_POP_FILE, NUTS_PATH
 
-REGIONS = [
-    "AT13",
-    "BE10",
-    "CZ010",
-    "DE3",
-    "ES30",
-    "FR10",
-    "HU101",
-    "HU110",
-    "NO01",
-    "SE11",
-    "SE110",
-    "UKI",
-]
-TIMEZONES = {
-    "AT13": "Europe/Vienna",
-    "BE10": "Europe/Brussels",
-    "CZ010": "Europe/Prague",
-    "DE3": "Europe/Berlin",
-    "ES30": "Europe/Madrid",
-    "FR10": "Europe/Paris",
-    "HU101": "Europe/Budapest",
-    "HU110": "Europe/Budapest",
-    "NO01": "Europe/Oslo",
-    "SE110": "Europe/Stockholm",
-    "SE11": "Europe/Stockholm",
-    "UKI": "Europe/London",
-}
+# the regions, in processing order, with their timezones
+REGIONS_INFO = MappingProxyType(
+    {
+        "AT13": "Europe/Vienna",
+        "BE10": "Europe/Brussels",
+        "CZ010": "Europe/Prague",
+        "DE3": "Europe/Berlin",
+        "ES30": "Europe/Madrid",
+        "FR10": "Europe/Paris",
+        "HU101": "Europe/Budapest",
+        "HU110": "Europe/Budapest",
+        "NO01": "Europe/Oslo",
+        "SE11": "Europe/Stockholm",
+        "SE110": "Europe/Stockholm",
+        "UKI": "Europe/London",
+    }
+)
+REGIONS = tuple(REGIONS_INFO)
+TIMEZONES = REGIONS_INFO
+
+# each region worker holds the hourly frame of a region for the whole period, so
+# the region pools of era5-download and era5-prepare are bounded by this
+REGION_WORKERS = 4
 
 ESS_FILES = [
     "ESS8e02_2.sav",
@@ -51,26 +53,60 @@ for path in [EEA_PATH, ERA5_PATH, TMP_PATH, NUTS_PATH]:
         path.mkdir()
 
 
-async def a_maybe_download(url, folder=None):
-    path = make_path(url, folder)
-    if not path.exists():
-        async with httpx.AsyncClient() as client:
-            res = await client.get(url, timeout=None)
-        res.raise_for_status()
-        data = res.content
-        with open(path, "wb") as f:
-            f.write(data)
-    return path
+# one connection pool pr event loop, so the connections are reused between downloads
+HTTP_LIMITS = httpx.Limits(max_connections=32, max_keepalive_connections=16)
+# the downloads are streamed to disk in chunks of this size
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+# an async client can only be used on the loop it was created on
+async_http_clients = weakref.WeakKeyDictionary()
+# the running downloads, by event loop and path
+downloads_in_flight = {}
+
+
+def get_async_http_client(limits=HTTP_LIMITS):
+    """
+    The shared async client of the running event loop. The limits only apply to
+    the call that creates the client, so a script that needs other limits gets
+    the client first.
+    """
+    loop = asyncio.get_running_loop()
+    if loop not in async_http_clients:
+        async_http_clients[loop] = httpx.AsyncClient(
+            http2=True, timeout=None, limits=limits
+        )
+    return async_http_clients[loop]
+
+
+async def close_async_http_client():
+    """
+    Close the shared async client of the running event loop, if it has one
+    """
+    client = async_http_clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
 
 
-def maybe_download(url, folder=None):
+async def a_download(url, path, client):
+    with open_part_file(path) as f:
+        async with client.stream("GET", url, timeout=None) as res:
+            res.raise_for_status()
+            async for chunk in res.aiter_bytes(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                f.write(chunk)
+
+
+async def a_maybe_download(url, folder=None, client=None):
     path = make_path(url, folder)
     if not path.exists():
-        res = httpx.get(url, timeout=None)
-        res.raise_for_status()
-        data = res.content
-        with open(path, "wb") as f:
-            f.write(data)
+        if client is None:
+            client = get_async_http_client()
+        # tasks asking for a file that is being downloaded wait for that download
+        key = (asyncio.get_running_loop(), path)
+        if key not in downloads_in_flight:
+            download = asyncio.ensure_future(a_download(url, path, client))
+            download.add_done_callback(lambda _: downloads_in_flight.pop(key))
+            downloads_in_flight[key] = download
+        # shielded, a cancelled waiter does not cancel the download of the others
+        await asyncio.shield(downloads_in_flight[key])
     return path
 
 
@@ -83,58 +119,156 @@ def make_path(url, folder):
     return path
 
 
-def load_nuts(folder=NUTS_PATH):
-    def make_level_df(level, year):
-        url = f"https://gisco-services.ec.europa.eu/distribution/v2/nuts/geojson/NUTS_RG_01M_{year}_4326_LEVL_{level}.geojson"
-        path = maybe_download(url, folder)
+@contextlib.contextmanager
+def open_part_file(path):
+    """
+    Downloads are written to a part file of their own and moved to path when they
+    are complete. An interrupted download is not taken for a downloaded file, and
+    downloads of the same file from other processes do not write into each other.
+    """
+    part_path = path.with_name(
+        f"{path.name}.{os.getpid()}.{threading.get_ident()}.part"
+    )
+    try:
+        with open(part_path, "wb") as f:
+            yield f
+        os.replace(part_path, path)
+    except BaseException:
+        part_path.unlink(missing_ok=True)
+        raise
+
+
+async def a_maybe_download_all(urls, folder=None):
+    """
+    Download the urls concurrently, over the shared client of the event loop
+    """
+    client = get_async_http_client()
+    return await asyncio.gather(
+        *[a_maybe_download(url, folder=folder, client=client) for url in urls]
+    )
+
+
+def make_nuts_url(level, year):
+    return f"https://gisco-services.ec.europa.eu/distribution/v2/nuts/geojson/NUTS_RG_01M_{year}_4326_LEVL_{level}.geojson"
 
-        cols = ["NUTS_ID", "LEVL_CODE", "CNTR_CODE", "geometry"]
-        level_df = geopandas.read_file(path).set_index("id")[cols]
-        return level_df
+
+# levels 1-3 from 2016, and level 3 from 2013 for the region missing for HU
+NUTS_URLS = [make_nuts_url(level, 2016) for level in range(1, 4)] + [
+    make_nuts_url(3, 2013)
+]
+
+
+def load_nuts(folder=NUTS_PATH, nuts_ids=None):
+    """
+    The NUTS regions with the ids in nuts_ids, or all of them if it is None
+    """
+    paths = [make_path(url, folder) for url in NUTS_URLS]
+    # only start an event loop when there is something to download
+    if not all(path.exists() for path in paths):
+        paths = asyncio.run(a_download_nuts(folder))
+    return read_nuts(paths, nuts_ids)
+
+
+async def a_download_nuts(folder):
+    # the loop of load_nuts ends here, so its client is closed with it
+    try:
+        return await a_maybe_download_all(NUTS_URLS, folder)
+    finally:
+        await close_async_http_client()
+
+
+async def a_load_nuts(folder=NUTS_PATH, nuts_ids=None):
+    """
+    load_nuts for code that already runs in an event loop
+    """
+    paths = await a_maybe_download_all(NUTS_URLS, folder)
+    return read_nuts(paths, nuts_ids)
+
+
+def read_nuts(paths, nuts_ids):
+    def make_level_df(path, nuts_ids):
+        # the needed columns of the whole level are cached as geoparquet, reading
+        # it is much faster than parsing the geojson again. a geojson downloaded
+        # after the cache was written replaces it
+        cache_path = path.with_suffix(".parquet")
+        if not cache_path.exists() or cache_path.stat().st_mtime < path.stat().st_mtime:
+            cols = ["NUTS_ID", "LEVL_CODE", "CNTR_CODE", "geometry"]
+            # pyogrio reads the features through arrow, and only the needed fields
+            level_df = geopandas.read_file(
+                path, engine="pyogrio", use_arrow=True, columns=["id", *cols[:-1]]
+            ).set_index("id")[cols]
+            # the same dtypes in every level, so the concat does not need to convert
+            level_df["LEVL_CODE"] = level_df["LEVL_CODE"].astype("int8")
+            with open_part_file(cache_path) as f:
+                level_df.to_parquet(f)
+
+        # only the row groups and rows of the regions in nuts_ids are read
+        filters = None if nuts_ids is None else [("NUTS_ID", "in", list(nuts_ids))]
+        return geopandas.read_parquet(cache_path, filters=filters)
 
     print("load_nuts")
-    nuts_df = pd.DataFrame()
-    for i in track(range(1, 4), description="Loading nuts"):
-        level_df = make_level_df(i, 2016)
-        nuts_df = pd.concat([nuts_df, level_df])
+    *level_paths, hu_path = paths
+
+    # collect the levels and concat once
+    level_dfs = []
+    for path in track(level_paths, description="Loading nuts"):
+        level_dfs.append(make_level_df(path, nuts_ids))
 
     # Missing for HU
-    level_df = make_level_df(3, 2013)
-    level_df = level_df[level_df["NUTS_ID"] == "HU101"]
-    nuts_df = pd.concat([nuts_df, level_df])
+    level_dfs.append(make_level_df(hu_path, ["HU101"]))
 
-    nuts_df = nuts_df.sort_index()
+    # indexed on the region id, the regions are looked up instead of scanned for
+    nuts_df = (
+        pd.concat(level_dfs, copy=False).set_index("NUTS_ID", drop=False).sort_index()
+    )
     print("NUTS_DF", nuts_df)
     return nuts_df
 
 
+def get_region_df(nuts_df, region_id: str) -> geopandas.GeoDataFrame:
+    # a list keeps the result a frame, so duplicate ids are still caught
+    region_df = nuts_df.loc[[region_id]]
+    assert len(region_df) == 1, region_df
+    return region_df
+
+
 def load_geostat(path: str, region_df: geopandas.GeoDataFrame) -> pd.DataFrame:
+    """
+    One row pr populated raster pixel in the region, with its value.
+
+    The rows are in raster order, sorted by row (y, north to south) and then by
+    x (west to east), with a default index.
+    """
     print("load_geostat")
     region_df = region_df.to_crs("ESRI:54009")
     dataarray = rxr.open_rasterio(path)
-    geometry = region_df.iloc[0].geometry
-    dfs = []
-    for i in track(dataarray[0], description=f"loading geostat data"):
-        i = i[i != dataarray.attrs["_FillValue"]]
-        if len(i) == 0:
-            continue
-        s = i.to_pandas()
-        y_val = int(i.coords.get("y").item())
-        line = LineString([(s.index[0], y_val), (s.index[-1], y_val)])
-        if geometry.crosses(line):
-            df = s.reset_index()
-            df["y"] = y_val
-            dfs.append(df)
-    conc = pd.concat(dfs, ignore_index=True)
-    rdf = geopandas.GeoDataFrame(
-        conc, geometry=geopandas.points_from_xy(conc.x, conc.y), crs="ESRI:54009"
+
+    # only the pixels within the bounding box of the region can be in the region,
+    # the raster is read lazily so only this window is read from the file
+    window = dataarray[0].rio.clip_box(*region_df.total_bounds)
+    values = window.to_numpy()
+
+    # positions of the pixels with a value, nonzero returns them in raster order
+    y_idx, x_idx = np.nonzero(values != dataarray.attrs["_FillValue"])
+    xs = window["x"].to_numpy()[x_idx]
+    ys = window["y"].to_numpy()[y_idx]
+
+    # one polygon against many points, test the coordinates against the (prepared)
+    # polygon directly, and only build points for the pixels in the region
+    in_region = shapely.vectorized.contains(region_df.iloc[0].geometry, xs, ys)
+    xs, ys = xs[in_region], ys[in_region]
+
+    # only the pixel columns, the region is known to the caller
+    pop_region_df = geopandas.GeoDataFrame(
+        {"x": xs, "y": ys, "value": values[y_idx[in_region], x_idx[in_region]]},
+        geometry=geopandas.points_from_xy(xs, ys),
+        crs="ESRI:54009",
     )
-    pop_region_df = region_df.overlay(rdf, keep_geom_type=False)
     return pop_region_df
 
 
-def filter_none(container):
-    return [item for item in container if item is not None]
+def flatten(containers):
+    return [item for container in containers for item in container]
 
 
 EEA_VARIABLE_LABELS = {
@@ -178,9 +312,9 @@ EEA_VALUE_LABELS = {
     4: "Very Poor",
     5: "Extremely poor",
 }
-EEA_VARIABLE_VALUE_LABELS = {
-    var: EEA_VALUE_LABELS
-    for var in [
+# every variable shares the one labels dict (pyreadstat only accepts dicts here)
+EEA_VARIABLE_VALUE_LABELS = dict.fromkeys(
+    [
         "aqiwdpm10",
         "aqiwdpm2_5",
         "aqiwdso2",
@@ -193,8 +327,9 @@ EEA_VARIABLE_VALUE_LABELS = {
         "aqiw2dno2",
         "aqiw2do3",
         "aqiw2d",
-    ]
-}
+    ],
+    EEA_VALUE_LABELS,
+)
 EEA_VARIABLE_FORMATS = {
     "aqiwdpm10": "F2.0",
     "aqiwdpm2_5": "F2.0",